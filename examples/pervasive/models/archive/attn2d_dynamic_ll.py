@@ -7,9 +7,14 @@
 
 import sys
 import math
+import contextlib
+from typing import Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint as cp
+from torch import Tensor
 
 # import torchvision.utils as vutils
 from fairseq import utils
@@ -125,6 +130,9 @@ class Attn2dWaitkModel(FairseqModel):
                             help='use checkpointing')
         parser.add_argument('--nonzero-padding', action='store_true',
                             help='Do not zero out padding positions in the conv activations')
+        parser.add_argument('--bf16-grid', action='store_true',
+                            help='run the convnets and the prediction over the grid '
+                                 'under bf16 autocast (fp32 weights, fp32 log-softmax)')
 
         # Controller
         parser.add_argument('--control-kernel-size', type=int, help='kernel size')
@@ -209,9 +217,14 @@ class Attn2dEncoder(FairseqEncoder):
         ) if args.add_positional_embeddings else None
 
         self.embedding_dropout = nn.Dropout(args.embeddings_dropout)
-        
+        self._scaled_weight = None
+
+    def train(self, mode=True):
+        self._scaled_weight = None
+        return super().train(mode)
+
     def forward(self, src_tokens, src_lengths=None, **kwargs):
-        x = self.embed_scale * self.embed_tokens(src_tokens)
+        x = _scaled_embed(self, src_tokens)
         if self.embed_positions is not None:
             x += self.embed_positions(src_tokens)
         x = self.embedding_dropout(x)
@@ -271,6 +284,15 @@ class Attn2dDecoder(FairseqIncrementalDecoder):
             left_pad=args.left_pad_target,
             learned=args.learned_pos,
         ) if args.add_positional_embeddings else None
+        # Static sinusoid table for the single-row lookups of incremental decoding
+        if isinstance(self.embed_positions, SinusoidalPositionalEmbedding):
+            pos_table = SinusoidalPositionalEmbedding.get_embedding(
+                args.max_target_positions + self.padding_idx + 1,
+                embed_dim, self.padding_idx,
+            )
+        else:
+            pos_table = None
+        self.register_buffer('_pos_table', pos_table, persistent=False)
 
         self.embedding_dropout = nn.Dropout(args.embeddings_dropout)
         self.input_dropout = nn.Dropout(args.input_dropout)
@@ -300,6 +322,7 @@ class Attn2dDecoder(FairseqIncrementalDecoder):
 
         else:
             self.projection = None
+        self.has_projection = self.projection is not None
         self.prediction_dropout = nn.Dropout(args.prediction_dropout)
         if self.share_input_output_embed:
             self.prediction = Linear(
@@ -331,6 +354,14 @@ class Attn2dDecoder(FairseqIncrementalDecoder):
             )
 
         self.detach_controls = args.detach_controls
+        self.memory_efficient = args.memory_efficient
+        self.bf16_grid = args.bf16_grid
+        self._scaled_weight = None
+        self._controller_stream = None
+
+    def train(self, mode=True):
+        self._scaled_weight = None
+        return super().train(mode)
 
     def upgrade_state_dict(self, state_dict):
         current_state = self.state_dict()
@@ -340,50 +371,85 @@ class Attn2dDecoder(FairseqIncrementalDecoder):
                 state_dict[k] = current_state[k.replace('decoder.', '')]
         return state_dict
 
+    def _get_cached_context(self, encoder_out, incremental_state, context_size):
+        """
+        Source embeddings (B, Ts, ds) and padding mask (B, Ts) sliced to the
+        current context. Both are invariant across decoding steps and only
+        rebuilt when the context grows.
+        """
+        Ts = encoder_out['encoder_out'].size(1)
+        context_size = Ts if context_size is None else min(context_size, Ts)
+        cached = utils.get_incremental_state(self, incremental_state, 'src_grid')
+        if cached is not None and cached['src'].size(1) == context_size:
+            return cached['src'], cached['mask']
+        src_emb, encoder_mask = _slice_context(encoder_out, context_size)
+        # pack the slice once so every step's grid copy reads contiguous rows
+        src_emb = src_emb.contiguous()
+        utils.set_incremental_state(self, incremental_state, 'src_grid',
+                                    {'src': src_emb, 'mask': encoder_mask})
+        return src_emb, encoder_mask
+
+    def reorder_incremental_state(self, incremental_state, new_order):
+        super().reorder_incremental_state(incremental_state, new_order)
+        cached = utils.get_incremental_state(self, incremental_state, 'src_grid')
+        if cached is not None:
+            for k in cached.keys():
+                if cached[k] is not None:
+                    cached[k] = cached[k].index_select(0, new_order)
+            utils.set_incremental_state(self, incremental_state, 'src_grid', cached)
+
     def forward(self, prev_output_tokens, encoder_out,
                 incremental_state=None,
                 context_size=None,
                 cache_decoder=True, **kwargs):
-        encoder_states = encoder_out['encoder_out']
         # source embeddings
-        Ts = encoder_states.size(1)
-        if context_size is not None:
-            src_emb = encoder_states[:, :context_size]
+        if incremental_state is not None and cache_decoder:
+            src_emb, encoder_mask = self._get_cached_context(
+                encoder_out, incremental_state, context_size
+            )
+        else:
+            src_emb, encoder_mask = _slice_context(encoder_out, context_size)
         # target embeddings:
-        positions = self.embed_positions(
-            prev_output_tokens,
-            incremental_state=incremental_state if cache_decoder else None,
-        ) if self.embed_positions is not None else None
-
         if incremental_state is not None and cache_decoder:
             # embed the last target token
+            position = self.padding_idx + prev_output_tokens.size(1)
+            if self._pos_table is not None and position < self._pos_table.size(0):
+                positions = self._pos_table[position]
+            elif self.embed_positions is not None:
+                # learned positions, or past the static table: the
+                # sinusoidal module grows its own one
+                positions = self.embed_positions(
+                    prev_output_tokens,
+                    incremental_state=incremental_state,
+                )[:, -1:]
+            else:
+                positions = None
             prev_output_tokens = prev_output_tokens[:, -1:]
-            if positions is not None:
-                positions = positions[:, -1:]
-            
-        decoder_mask = prev_output_tokens.eq(self.padding_idx)
-        if not decoder_mask.any():
+            # A generated token is never padding: skip the mask and
+            # the host-device sync of .any() at every step.
             decoder_mask = None
+        else:
+            positions = self.embed_positions(
+                prev_output_tokens,
+                incremental_state=None,
+            ) if self.embed_positions is not None else None
+            decoder_mask = prev_output_tokens.eq(self.padding_idx)
+            if not decoder_mask.any():
+                decoder_mask = None
 
         # Build the full grid
-        tgt_emb = self.embed_scale * self.embed_tokens(prev_output_tokens)
+        tgt_emb = _scaled_embed(self, prev_output_tokens)
         if positions is not None:
             tgt_emb += positions
 
         tgt_emb = self.embedding_dropout(tgt_emb)
-                
-        src_length = src_emb.size(1)
-        tgt_length = tgt_emb.size(1)
 
         # build 2d "image" of embeddings
-        src_emb = _expand(src_emb, 1, tgt_length)  # B, Tt, Ts, ds
-        tgt_emb = _expand(tgt_emb, 2, src_length)  # B, Tt, Ts, dt
-        x = torch.cat((src_emb, tgt_emb), dim=3)   # B, Tt, Ts, C=ds+dt
-        x = self.input_dropout(x)
+        x = _build_grid(src_emb, tgt_emb,
+                        self.input_dropout.p, self.training)  # B, Tt, Ts, C=ds+dt
         # pass through dense convolutional layers
-        encoder_mask = encoder_out['encoder_padding_mask']
         x = self.net(
-            x, 
+            x,
             decoder_mask=decoder_mask,
             encoder_mask=encoder_mask,
             incremental_state=incremental_state if cache_decoder else None
@@ -394,16 +460,31 @@ class Attn2dDecoder(FairseqIncrementalDecoder):
             x = x[:, -1:]
         
         # x = self.aggregator(x)
-        x, _ = x.max(dim=2)  # B, Tt, C
-        x = self.projection(x) if self.projection is not None else x  # B, Tt, C
-        x = self.prediction_dropout(x)
-
+        x = torch.amax(x, dim=2)  # B, Tt, C
         # multiply by embedding matrix to generate distribution
-        x = self.prediction(x)  # B, Tt, V
+        x = self.output_layer(x)  # B, Tt, V
         return x, None
 
+    def _grid_autocast(self, x):
+        """ bf16 autocast for the passes over the grid, see --bf16-grid """
+        if not (self.bf16_grid and x.is_cuda):
+            # a disabled autocast would turn off the caller's own one
+            return contextlib.nullcontext()
+        return torch.autocast('cuda', dtype=torch.bfloat16)
+
+    def output_layer(self, x):
+        """ projection >> prediction dropout >> prediction """
+        return _output_head(
+            x,
+            self.projection.weight if self.has_projection else None,
+            self.projection.bias if self.has_projection else None,
+            self.prediction.weight,
+            self.prediction.bias,
+            self.prediction_dropout.p,
+            self.training,
+        )
+
     def decide(self, prev_output_tokens, encoder_out, context_size):
-        torch.set_printoptions(precision=2)
         # source embeddings
         src_emb = encoder_out['encoder_out'][:, :context_size]  # B, Ts, ds 
         # target embeddings:
@@ -412,23 +493,18 @@ class Attn2dDecoder(FairseqIncrementalDecoder):
             incremental_state=None,
         ) if self.embed_positions is not None else None
         # Build the full grid
-        tgt_emb = self.embed_scale * self.embed_tokens(prev_output_tokens)
+        tgt_emb = _scaled_embed(self, prev_output_tokens)
         if positions is not None:
             tgt_emb += positions
         tgt_emb = self.embedding_dropout(tgt_emb)
-        src_length = src_emb.size(1)
-        tgt_length = tgt_emb.size(1)
         # build 2d "image" of embeddings
-        src_emb = _expand(src_emb, 1, tgt_length)  # B, Tt, Ts, ds
-        tgt_emb = _expand(tgt_emb, 2, src_length)  # B, Tt, Ts, dt
-        x = torch.cat((src_emb, tgt_emb), dim=3)   # B, Tt, Ts, C=ds+dt
+        x = _build_grid(src_emb, tgt_emb)  # B, Tt, Ts, C=ds+dt
         obs = self.controller_feat(x)
         controls = self.controller.predict_read_write(obs) 
         pwrite = torch.exp(controls[:,-1,-1,1])
         return pwrite 
 
     def forward_train(self, prev_output_tokens, encoder_out, target, **kwargs):
-        torch.set_printoptions(precision=2)
         # source embeddings
         src_emb = encoder_out['encoder_out']  # B, Ts, ds 
         # target embeddings:
@@ -442,51 +518,72 @@ class Attn2dDecoder(FairseqIncrementalDecoder):
             decoder_mask = None
 
         # Build the full grid
-        tgt_emb = self.embed_scale * self.embed_tokens(prev_output_tokens)
+        tgt_emb = _scaled_embed(self, prev_output_tokens)
         if positions is not None:
             tgt_emb += positions
         tgt_emb = self.embedding_dropout(tgt_emb)
-        batch_size = src_emb.size(0)
         src_length = src_emb.size(1)
-        tgt_length = tgt_emb.size(1)
 
         # build 2d "image" of embeddings
-        src_emb = _expand(src_emb, 1, tgt_length)  # B, Tt, Ts, ds
-        tgt_emb = _expand(tgt_emb, 2, src_length)  # B, Tt, Ts, dt
-        x = torch.cat((src_emb, tgt_emb), dim=3)   # B, Tt, Ts, C=ds+dt
-        x = self.input_dropout(x)
-
-        if self.detach_controls:
-            observations = self.controller_feat(x.clone().detach())
+        x = _build_grid(src_emb, tgt_emb,
+                        self.input_dropout.p, self.training)  # B, Tt, Ts, C=ds+dt
+
+        controller_input = x.detach() if self.detach_controls else x
+        overlap = controller_input.is_cuda
+        if overlap:
+            # Both nets read the same grid: compute the controller features
+            # on a side stream while the convnet runs on the default one.
+            main_stream = torch.cuda.current_stream()
+            if self._controller_stream is None:
+                self._controller_stream = torch.cuda.Stream(device=x.device)
+            self._controller_stream.wait_stream(main_stream)
+            controller_input.record_stream(self._controller_stream)
+            with torch.cuda.stream(self._controller_stream), self._grid_autocast(x):
+                observations = self.controller_feat(controller_input)
         else:
-            observations = self.controller_feat(x)
+            with self._grid_autocast(x):
+                observations = self.controller_feat(controller_input)
         # pass through dense convolutional layers
         encoder_mask = encoder_out['encoder_padding_mask']
-        x = self.net(
-            x, 
-            decoder_mask=decoder_mask,
-            encoder_mask=encoder_mask,
-            incremental_state=None,
-        )  # B, Tt, Ts, C
-        x, _ = self.aggregator(x)  # B, Tt, Ts, C
-        x = self.projection(x) if self.projection is not None else x  # B, Tt, C
-
-        # Predict
-        x = self.prediction_dropout(x)
-        x = self.prediction(x)  # B, Tt, Ts, V
+        grid_mask = _grid_mask(decoder_mask, encoder_mask)
+
+        def run_net(x):
+            with self._grid_autocast(x):
+                return self.net(
+                    x,
+                    decoder_mask=decoder_mask,
+                    encoder_mask=encoder_mask,
+                    incremental_state=None,
+                )  # B, Tt, Ts, C
+
+        if self.memory_efficient and x.requires_grad:
+            # Do not keep the convnet activations alive through the
+            # prediction/controller passes, recompute them in backward
+            x = cp.checkpoint(run_net, x, use_reentrant=False)
+        else:
+            x = run_net(x)
+        if overlap:
+            main_stream.wait_stream(self._controller_stream)
+            observations.record_stream(main_stream)
+        # The controller and the losses run in fp32
+        observations = observations.float()
+        with self._grid_autocast(x):
+            x, _ = self.aggregator(x)  # B, Tt, Ts, C
+            # Predict
+            x = self.output_layer(x)  # B, Tt, Ts, V
+        # The full log-probs are returned: dynamic_ll_loss smooths the
+        # labels over the whole vocabulary, not only the gathered column.
         x = utils.log_softmax(x, dim=-1)
 
         with torch.no_grad():
             # Gather log p(ground truth)
-            scores = x.view(-1, x.size(-1)).gather(
+            scores = x.gather(
                 dim=-1,
-                index=target.unsqueeze(-1).expand(-1, -1, src_length).contiguous().view(-1, 1)
-            ).view(batch_size, tgt_length, src_length)
+                index=target[:, :, None, None].expand(-1, -1, src_length, 1)
+            ).squeeze(-1)  # B, Tt, Ts
             # Forbid padding positions:
-            if encoder_mask is not None:
-                scores = scores.masked_fill(encoder_mask.unsqueeze(1), -1000)
-            if decoder_mask is not None:
-                scores = scores.masked_fill(decoder_mask.unsqueeze(-1), -1000)
+            if grid_mask is not None:
+                scores = scores.masked_fill(grid_mask, -1000)
 
         controls, gamma, read_labels, write_labels = self.controller(observations, scores)
         return x, observations, controls, gamma, read_labels, write_labels
@@ -496,6 +593,7 @@ class Attn2dDecoder(FairseqIncrementalDecoder):
 def base_architecture(args):
     args.memory_efficient = getattr(args, 'memory_efficient', False)
     args.nonzero_padding = getattr(args, 'nonzero_padding', False)
+    args.bf16_grid = getattr(args, 'bf16_grid', False)
 
     args.conv_bias = getattr(args, 'conv_bias', False)
     args.aggregation = getattr(args, 'aggregation', 'max')
@@ -546,10 +644,66 @@ def base_architecture(args):
     args.control_kernel_size = getattr(args, 'control_kernel_size', 3)
 
 
-def _expand(tensor, dim, reps):
-    tensor = tensor.unsqueeze(dim)
-    shape = tuple(reps if i == dim else -1 for i in range(tensor.dim()))
-    return tensor.expand(shape)
+def _slice_context(encoder_out, context_size=None):
+    """ Source embeddings and padding mask restricted to the first context_size tokens """
+    src_emb = encoder_out['encoder_out']
+    encoder_mask = encoder_out['encoder_padding_mask']
+    if context_size is not None and context_size < src_emb.size(1):
+        src_emb = src_emb[:, :context_size]
+        if encoder_mask is not None:
+            encoder_mask = encoder_mask[:, :context_size]
+            if not encoder_mask.any():
+                encoder_mask = None
+    return src_emb, encoder_mask
+
+
+def _grid_mask(decoder_mask, encoder_mask):
+    """ Padding positions of the (B, Tt, Ts) grid, None if there are none """
+    if decoder_mask is None:
+        return None if encoder_mask is None else encoder_mask.unsqueeze(1)
+    if encoder_mask is None:
+        return decoder_mask.unsqueeze(-1)
+    return decoder_mask.unsqueeze(-1) | encoder_mask.unsqueeze(1)
+
+
+def _output_head(x, proj_weight: Optional[Tensor], proj_bias: Optional[Tensor],
+                 weight, bias: Optional[Tensor], p: float, training: bool):
+    """ The output head shared by forward and forward_train """
+    if proj_weight is not None:
+        x = F.linear(x, proj_weight, proj_bias)
+    x = F.dropout(x, p=p, training=training)
+    return F.linear(x, weight, bias)
+
+
+def _scaled_embed(module, tokens):
+    """
+    embed_scale * embed_tokens(tokens)
+    At inference the scaled embedding table is computed once and the
+    lookups read from it, instead of rescaling the embeddings every call.
+    The table is dropped on train()/eval() and whenever the weight changes.
+    """
+    if module.training or torch.is_grad_enabled():
+        return module.embed_scale * module.embed_tokens(tokens)
+    weight = module.embed_tokens.weight
+    key = (weight.data_ptr(), weight._version)
+    if module._scaled_weight is None or module._scaled_weight[0] != key:
+        module._scaled_weight = (key, module.embed_scale * weight)
+    return F.embedding(tokens, module._scaled_weight[1], module.padding_idx)
+
+
+def _build_grid(src_emb, tgt_emb, p=0., training=False):
+    """
+    Concatenate src_emb (B, Ts, ds) and tgt_emb (B, Tt, dt) into the
+    (B, Tt, Ts, ds+dt) grid with input dropout applied in place.
+    Each embedding is broadcast-copied straight into its slab of a single
+    preallocated output instead of expanding both and concatenating.
+    """
+    bsz, src_length, ds = src_emb.size()
+    tgt_length = tgt_emb.size(1)
+    x = src_emb.new_empty((bsz, tgt_length, src_length, ds + tgt_emb.size(-1)))
+    x[..., :ds].copy_(src_emb.unsqueeze(1))
+    x[..., ds:].copy_(tgt_emb.unsqueeze(2))
+    return F.dropout(x, p=p, training=training, inplace=True)
 
 
 def PositionalEmbedding(num_embeddings, embedding_dim,
@@ -136,6 +136,9 @@ class Attn2dCPModel(FairseqModel):
                             help='Do not zero out padding positions in the conv activations')
         parser.add_argument('--agg-zero-padding', action='store_true',
                             help='Do not zero out padding positions before aggregation')
+        parser.add_argument('--bf16-grid', action='store_true',
+                            help='run the resnet6 convolutions and FFNs under bf16 '
+                                 'autocast (fp32 weights, fp32 residual stream)')
         parser.add_argument('--num-heads', type=int)
         parser.add_argument('--need-attention-weights', action='store_true')
         # Decoding path:
@@ -683,6 +686,7 @@ def base_architecture(args):
     args.memory_efficient = getattr(args, 'memory_efficient', False)
     args.nonzero_padding = getattr(args, 'nonzero_padding', False)
     args.agg_zero_padding = getattr(args, 'agg_zero_padding', False)
+    args.bf16_grid = getattr(args, 'bf16_grid', False)
 
     args.conv_bias = getattr(args, 'conv_bias', False)
     args.aggregation = getattr(args, 'aggregation', 'max')
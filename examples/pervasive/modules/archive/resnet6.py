@@ -5,20 +5,24 @@
 # the root directory of this source tree. An additional grant of patent rights
 # can be found in the PATENTS file in the same directory.
 
+import contextlib
+from typing import Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch import Tensor
 
-# import torch.utils.checkpoint as cp
+import torch.utils.checkpoint as cp
 
 from fairseq.modules import (
     MaskedConvolution, MultiheadMaskedConvolution
 )
 
 def get_stats(x):
-    """x in B, Tt, Ts, C """
-    x = x.contiguous().view(-1, x.size(-1))
-    return x.mean(0), x.std(0)
+    """x in B, Tt, Ts, C, any strides """
+    var, mean = torch.var_mean(x, dim=(0, 1, 2))
+    return mean, var.sqrt_()
 
 
 class ResNet6(nn.Module):
@@ -36,6 +40,7 @@ class ResNet6(nn.Module):
         num_features = num_features // args.divide_channels
         self.output_channels = num_features
         layer_type = args.layer_type
+        self.memory_efficient = args.memory_efficient
 
         self.residual_blocks = nn.ModuleList([])
         for _ in range(num_layers):
@@ -43,6 +48,77 @@ class ResNet6(nn.Module):
                 _ResLayer(num_features, kernel_size, args)
             )
         
+    def reduce(self, x):
+        """
+        B,Tt,Ts,C  >>  B,C,Tt,Ts in channels_last, i.e. a view of the input.
+        The layers keep this layout so that no activation is ever copied
+        between the convolutions and the FFN. The nn.Linear reduce_channels
+        is applied as a 1x1 convolution in this layout.
+        """
+        x = x.permute(0, 3, 1, 2).contiguous(memory_format=torch.channels_last)
+        if self.reduce_channels is not None:
+            x = F.conv2d(x,
+                         self.reduce_channels.weight.unsqueeze(-1).unsqueeze(-1),
+                         self.reduce_channels.bias)
+        return x
+
+    def segment(self, start, end, keep_mask=None):
+        """ Run residual_blocks[start:end] as a function of x alone """
+        def run_layers(x):
+            for layer in self.residual_blocks[start:end]:
+                x = layer(x, keep_mask=keep_mask)
+            return x
+        return run_layers
+
+    def keep_mask(self, x, encoder_mask=None, decoder_mask=None):
+        """
+        Multiplicative B, 1, Tt, Ts mask zeroing the padding positions of x.
+        Padding is only zeroed out in training, None otherwise.
+        """
+        if not self.training or (encoder_mask is None and decoder_mask is None):
+            return None
+        B, _, Tt, Ts = x.size()
+        keep = x.new_ones((B, 1, Tt, Ts))
+        if encoder_mask is not None:
+            keep = keep * (~encoder_mask).view(B, 1, 1, Ts).type_as(x)
+        if decoder_mask is not None:
+            keep = keep * (~decoder_mask).view(B, 1, Tt, 1).type_as(x)
+        return keep
+
+    def fuse_conv1(self):
+        """ Fold conv1 into mconv2 in every layer, see _ResLayer.fuse_conv1 """
+        return all([layer.fuse_conv1() for layer in self.residual_blocks])
+
+    def quantize_ffn(self):
+        """ int8 FFNs for CPU inference, see _ResLayer.quantize_ffn """
+        for layer in self.residual_blocks:
+            layer.quantize_ffn()
+
+    def compile_for_inference(self, x_example):
+        """
+        Trace the eval forward without masks nor incremental_state, e.g.
+        to score full grids, into a frozen TorchScript module.
+        x_example : B, Tt, Ts, C
+        The traced module is a separate handle; self is left in eval mode
+        and can be trained again with .train().
+        """
+        self.eval()
+        with torch.no_grad():
+            traced = torch.jit.trace(self, x_example)
+        return torch.jit.optimize_for_inference(traced)
+
+    def compiled(self, mode='max-autotune', **kwargs):
+        """
+        Return a torch.compile'd handle of the network, self is left as is
+        (unlike nn.Module.compile which compiles in place). The activations
+        are channels_last already, the parameters are not converted so that
+        they can still be flattened by the optimizers.
+        Compiling happens on the first calls and is slow, more so with
+        max-autotune; grids of new shapes are recompiled with dynamic
+        shapes once, not for every Tt, Ts.
+        """
+        return torch.compile(self, mode=mode, **kwargs)
+
     def forward_stats(self, x,
                       encoder_mask=None,
                       decoder_mask=None,
@@ -52,18 +128,17 @@ class ResNet6(nn.Module):
         Input : B, Tt, Ts, C
         Output : B, Tt, Ts, C
         """
-        if self.reduce_channels is not None:
-            x = self.reduce_channels(x)
-        stats = [get_stats(x)]
+        x = self.reduce(x)
+        stats = [get_stats(x.permute(0, 2, 3, 1))]
+        keep_mask = self.keep_mask(x, encoder_mask, decoder_mask)
         for layer in self.residual_blocks:
             x, xattn = layer.forward_split(
                 x,
-                encoder_mask=encoder_mask,
-                decoder_mask=decoder_mask,
+                keep_mask=keep_mask,
                 incremental_state=incremental_state
             )
-            stats.append(get_stats(xattn))
-            stats.append(get_stats(x))
+            stats.append(get_stats(xattn.permute(0, 2, 3, 1)))
+            stats.append(get_stats(x.permute(0, 2, 3, 1)))
         return (stats)
 
     def forward(self, x,
@@ -75,19 +150,30 @@ class ResNet6(nn.Module):
         Input : B, Tt, Ts, C
         Output : B, Tt, Ts, C
         """
-        if self.reduce_channels is not None:
-            x = self.reduce_channels(x)
-        for layer in self.residual_blocks:
-            x = layer(x,
-                      encoder_mask=encoder_mask,
-                      decoder_mask=decoder_mask,
-                      incremental_state=incremental_state
-                     )
-        return x
+        x = self.reduce(x)
+        keep_mask = self.keep_mask(x, encoder_mask, decoder_mask)
+        if self.memory_efficient and x.requires_grad and incremental_state is None:
+            # Only keep the inputs of segments of ~sqrt(num_layers) layers,
+            # the layers' activations are recomputed in the backward pass
+            num_layers = len(self.residual_blocks)
+            segment = max(1, int(num_layers ** .5))
+            for start in range(0, num_layers, segment):
+                x = cp.checkpoint(
+                    self.segment(start, start + segment, keep_mask), x,
+                    use_reentrant=False,
+                )
+        else:
+            for layer in self.residual_blocks:
+                x = layer(x,
+                          keep_mask=keep_mask,
+                          incremental_state=incremental_state
+                         )
+        # Back to the original shape B,Tt,Ts,C
+        return x.permute(0, 2, 3, 1)
 
 
 class _ResLayer(nn.Module):
-    """ Single residual layer
+    """ Single residual layer, operates on B, C, Tt, Ts (channels_last)
 
     num_input_features - number of input channels to the layer
     kernel_size - size of masked convolution, k x (k // 2)
@@ -96,7 +182,7 @@ class _ResLayer(nn.Module):
 
     def __init__(self, num_features, kernel_size, args):
         super().__init__()
-        self.drop_rate = args.convolution_dropout
+        self.drop_rate = float(args.convolution_dropout)
         ffn_dim = args.ffn_dim
         mid_features = args.reduce_dim
         stride = args.conv_stride  # source dimension stride
@@ -132,71 +218,164 @@ class _ResLayer(nn.Module):
         self.fc2 = Linear(ffn_dim, num_features)
         # self.ln2 = nn.LayerNorm(num_features)
         self.scale = 1.
+        self.bf16 = args.bf16_grid
+        self._qffn = None
+
+    @torch.no_grad()
+    def fuse_conv1(self):
+        """
+        Fold the bias-free 1x1 conv1 into mconv2 so that the masked
+        convolution reads the layer input directly (inference only,
+        call once the checkpoint is loaded). Only done for ungrouped
+        convolutions: folding into a grouped mconv2 would densify it.
+        Returns True if conv1 is folded.
+        """
+        if self.conv1 is None:
+            return True
+        if self.mconv2.groups != 1 or self.conv1.bias is not None:
+            return False
+        w1 = self.conv1.weight.squeeze(-1).squeeze(-1)  # mid, C
+        w2 = self.mconv2.weight * self.mconv2.mask  # C, mid, k, k
+        weight = torch.einsum('oihw,ij->ojhw', w2, w1)  # C, C, k, k
+        # The mask only depends on the kernel position
+        self.mconv2.mask = self.mconv2.mask[:, :1].expand_as(weight).contiguous()
+        self.mconv2.weight = nn.Parameter(weight)
+        self.mconv2.in_channels = self.mconv2.inc = weight.size(1)
+        self.conv1 = None
+        return True
+
+    def quantize_ffn(self):
+        """
+        Keep int8 dynamically quantized copies of fc1 and fc2 for CPU
+        inference (call once the checkpoint is loaded). The copies are not
+        registered as submodules, the fp32 FFN and the state_dict are left
+        untouched and still serve training, CUDA and small inputs.
+        """
+        fc1, fc2 = torch.ao.quantization.quantize_dynamic(
+            nn.Sequential(self.fc1, self.fc2), {nn.Linear}, dtype=torch.qint8
+        )
+        self._qffn = (fc1, fc2)
+
+    def autocast(self, x):
+        """
+        bf16 autocast for the convolutions and the FFN (see --bf16-grid).
+        The residual stream stays in fp32: the bf16 branch is promoted
+        back to fp32 by the residual add, see add_residual.
+        """
+        if not (self.bf16 and x.is_cuda):
+            # a disabled autocast would turn off the caller's own one
+            return contextlib.nullcontext()
+        return torch.autocast('cuda', dtype=torch.bfloat16)
+
+    def add_residual(self, x, residual, keep_mask=None):
+        """
+        Dropout and residual add of the branch output x. Outside autograd
+        x is a fresh tensor and the sum is accumulated into it in place,
+        saving an allocation per add when decoding.
+        """
+        if torch.is_grad_enabled():
+            return add_dropout(x, residual, keep_mask,
+                               self.drop_rate, self.training, self.scale)
+        if self.training or x.dtype != residual.dtype:
+            return scripted_add_dropout(x, residual, keep_mask,
+                                        self.drop_rate, self.training, self.scale)
+        if keep_mask is not None:
+            x *= keep_mask
+        x += residual
+        if self.scale != 1.:
+            x *= self.scale
+        return x
+
+    def ffn(self, x):
+        """ fc1 >> relu >> fc2 >> dropout >> residual """
+        # int8 GEMMs only pay off from 16 rows (B x Tt x Ts positions) on
+        if (self._qffn is not None and not self.training and not x.is_cuda
+                and x.numel() // x.size(1) >= 16):
+            fc1, fc2 = self._qffn
+            # channels_last B,C,Tt,Ts  >>  a B,Tt,Ts,C view for the Linears
+            h = fc2(F.relu(fc1(x.permute(0, 2, 3, 1)))).permute(0, 3, 1, 2)
+        elif torch.is_grad_enabled():
+            h = ffn_branch(x,
+                           self.fc1.weight, self.fc1.bias,
+                           self.fc2.weight, self.fc2.bias)
+        else:
+            h = scripted_ffn_branch(x,
+                                    self.fc1.weight, self.fc1.bias,
+                                    self.fc2.weight, self.fc2.bias)
+        return self.add_residual(h, x)
 
     def forward_split(self, x,
-                      encoder_mask=None,
-                      decoder_mask=None,
+                      keep_mask=None,
                       incremental_state=None):
-        residual = x 
-        x = x.permute(0, 3, 1, 2)
-        x = self.conv1(x)
-        # x = F.relu(x)
-        x = self.mconv2(x, incremental_state)
-        if self.training:
-            if encoder_mask is not None:
-                x = x.masked_fill(encoder_mask.unsqueeze(1).unsqueeze(1), 0)
-            if decoder_mask is not None:
-                x = x.masked_fill(decoder_mask.unsqueeze(1).unsqueeze(-1), 0)
-
-        if self.drop_rate:
-            x = F.dropout(x, p=self.drop_rate, training=self.training)
-        x = x.permute(0, 2, 3, 1)
-        x = self.scale * (x + residual)  # B, C, Tt, Ts
-        # x = self.ln1(x)
-        # FFN:
-        residual = x
-        x = self.fc1(x)
-        x = F.relu(x)
-        x = self.fc2(x)
-        if self.drop_rate:
-            x = F.dropout(x, p=self.drop_rate, training=self.training)
-        x = self.scale * (x + residual)
+        with self.autocast(x):
+            residual = x
+            if self.conv1 is not None:
+                x = self.conv1(x)
+            # x = F.relu(x)
+            x = self.mconv2(x, incremental_state)
+            x = self.add_residual(x, residual, keep_mask)  # B, C, Tt, Ts
+            # x = self.ln1(x)
+            # FFN:
+            residual = x
+            x = self.ffn(x)
         # x = self.ln2(x)
         return x, residual
 
     def forward(self, x,
-                encoder_mask=None,
-                decoder_mask=None,
+                keep_mask=None,
                 incremental_state=None
                ):
-        residual = x
-        x = x.permute(0, 3, 1, 2)
-        x = self.conv1(x)
-        # x = F.relu(x)
-        x = self.mconv2(x, incremental_state)
-        if self.training:
-            if encoder_mask is not None:
-                x = x.masked_fill(encoder_mask.unsqueeze(1).unsqueeze(1), 0)
-            if decoder_mask is not None:
-                x = x.masked_fill(decoder_mask.unsqueeze(1).unsqueeze(-1), 0)
-
-        if self.drop_rate:
-            x = F.dropout(x, p=self.drop_rate, training=self.training)
-        x = x.permute(0, 2, 3, 1)
-        x = self.scale * (x + residual)  # B, C, Tt, Ts
-        # x = self.ln1(x)
-        # FFN:
-        residual = x
-        x = self.fc1(x)
-        x = F.relu(x)
-        x = self.fc2(x)
-        if self.drop_rate:
-            x = F.dropout(x, p=self.drop_rate, training=self.training)
-        x = self.scale * (x + residual)
+        """
+        x in B, C, Tt, Ts
+        keep_mask : B, 1, Tt, Ts multiplicative padding mask, see ResNet6.keep_mask
+        """
+        with self.autocast(x):
+            residual = x
+            if self.conv1 is not None:
+                x = self.conv1(x)
+            # x = F.relu(x)
+            x = self.mconv2(x, incremental_state)
+            x = self.add_residual(x, residual, keep_mask)  # B, C, Tt, Ts
+            # x = self.ln1(x)
+            # FFN:
+            residual = x
+            x = self.ffn(x)
         # x = self.ln2(x)
         return x
 
 
+def add_dropout(x, residual, keep_mask: Optional[Tensor],
+                p: float, training: bool, scale: float):
+    """ scale * (dropout(x * keep_mask) + residual) """
+    if keep_mask is not None:
+        x = x * keep_mask
+    x = F.dropout(x, p=p, training=training) + residual
+    # skip the multiply for the default scale=1
+    if scale != 1.:
+        x = scale * x
+    return x
+
+
+def ffn_branch(x, w1, b1: Optional[Tensor], w2, b2: Optional[Tensor]):
+    """
+    Position-wise FFN over the channels of x in B, C, Tt, Ts.
+    x is flattened once to B*Tt*Ts, C (a view for channels_last x) so
+    that both Linears are single addmm GEMMs with their bias fused.
+    """
+    B, C, Tt, Ts = x.size()
+    h = x.permute(0, 2, 3, 1).reshape(-1, C)
+    h = F.relu(F.linear(h, w1, b1))
+    h = F.linear(h, w2, b2)
+    return h.view(B, Tt, Ts, -1).permute(0, 3, 1, 2)
+
+
+# Scripted copies for the passes outside autograd only: under autograd
+# TorchScript swaps the native dropout / relu backward for its own
+# formulas, which is slower than the eager functions.
+scripted_add_dropout = torch.jit.script(add_dropout)
+scripted_ffn_branch = torch.jit.script(ffn_branch)
+
+
 def Linear(in_features, out_features, bias=True):
     m = nn.Linear(in_features, out_features, bias)
     nn.init.xavier_uniform_(m.weight)
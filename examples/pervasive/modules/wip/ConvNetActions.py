@@ -32,9 +32,11 @@ class ConvNetActions(nn.Module):
         Output : N, Tt, Ts, C
         """
         add_up = x
-        for layer in self.residual_blocks:
+        for i, layer in enumerate(self.residual_blocks):
             x = layer(x)
-            add_up += x
+            # The input grid is shared with the decoder's convnet,
+            # only accumulate in place once it has been copied.
+            add_up = add_up + x if not i else add_up.add_(x)
         return self.final_ln(add_up)
 
 